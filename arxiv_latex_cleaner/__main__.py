@@ -28,6 +28,15 @@ from ._version import __version__
 from .arxiv_latex_cleaner import merge_args_into_config
 from .arxiv_latex_cleaner import run_arxiv_cleaner
 
+
+def _positive_int(value):
+  """Parses a strictly positive integer argument."""
+  number = int(value)
+  if number < 1:
+    raise argparse.ArgumentTypeError(f"{value} is not a positive integer.")
+  return number
+
+
 PARSER = argparse.ArgumentParser(
     prog="arxiv_latex_cleaner@{0}".format(__version__),
     description=(
@@ -212,6 +221,16 @@ PARSER.add_argument(
     ),
 )
 
+PARSER.add_argument(
+    "--jobs",
+    default=None,
+    type=_positive_int,
+    help=(
+        "Number of parallel workers used to clean the tex files and resize "
+        "the figures. Default: number of CPUs."
+    ),
+)
+
 PARSER.add_argument(
     "--config",
     type=str,
@@ -229,25 +248,32 @@ PARSER.add_argument(
     help="Enable detailed output.",
 )
 
-ARGS = vars(PARSER.parse_args())
 
-if ARGS["config"] is not None:
-  try:
-    with open(ARGS["config"], "r") as config_file:
-      config_params = yaml.safe_load(config_file)
-    final_args = merge_args_into_config(ARGS, config_params)
+def main():
+  """Runs the cleaner with the command line arguments."""
+  args = vars(PARSER.parse_args())
+
+  if args["config"] is not None:
+    try:
+      with open(args["config"], "r") as config_file:
+        config_params = yaml.safe_load(config_file)
+      final_args = merge_args_into_config(args, config_params)
+
+    except FileNotFoundError:
+      print("config file {} not found.".format(args["config"]))
+      final_args = args
+      final_args.pop("config", None)
+  else:
+    final_args = args
+
+  if final_args.get("verbose", False):
+    logging.basicConfig(level=logging.INFO)
+  else:
+    logging.basicConfig(level=logging.ERROR)
 
-  except FileNotFoundError:
-    print(f"config file {ARGS.config} not found.")
-    final_args = ARGS
-    final_args.pop("config", None)
-else:
-  final_args = ARGS
+  run_arxiv_cleaner(final_args)
+  exit(0)
 
-if final_args.get("verbose", False):
-  logging.basicConfig(level=logging.INFO)
-else:
-  logging.basicConfig(level=logging.ERROR)
 
-run_arxiv_cleaner(final_args)
-exit(0)
+if __name__ == "__main__":
+  main()
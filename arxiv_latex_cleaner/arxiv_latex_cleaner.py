@@ -14,18 +14,27 @@
 # limitations under the License.
 """Cleans the LaTeX code of your paper to submit to arXiv."""
 import collections
+import concurrent.futures
 import contextlib
-import copy
+import functools
 import logging
 import os
 import pathlib
+import re
 import shutil
+import string
 import subprocess
 import tempfile
+import warnings
 
 from PIL import Image
 import regex
 
+try:
+  import ahocorasick
+except ImportError:
+  ahocorasick = None
+
 PDF_RESIZE_COMMAND = (
     'gs -sDEVICE=pdfwrite -dCompatibilityLevel=1.4 -dNOPAUSE -dQUIET -dBATCH '
     '-dDownsampleColorImages=true -dColorImageResolution={resolution} '
@@ -33,6 +42,11 @@ PDF_RESIZE_COMMAND = (
     '-sOutputFile={output} {input}'
 )
 MAX_FILENAME_LENGTH = 120
+# Maximum number of figures resized concurrently, e.g. ghostscript processes.
+MAX_FIGURE_WORKERS = 8
+# Extensions of the figures that are resized with PIL.
+_RASTER_EXTS = frozenset({'.jpg', '.jpeg', '.png'})
+_JPEG_EXTS = frozenset({'.jpg', '.jpeg'})
 
 # Fix for Windows: Even if '\' (os.sep) is the standard way of making paths on
 # Windows, it interferes with regular expressions. We just change os.sep to '/'
@@ -52,129 +66,326 @@ if os.name == 'nt':
   os.path.join = new_os_join
 
 
+# Patterns that do not depend on the parameters are compiled once at import.
+_AUTO_IGNORE_RE = regex.compile(r'(%\s*auto-ignore).*')
+_BRACE_TOKEN_RE = re.compile(r'\\.|[{}]', re.DOTALL)
+_OPTIONAL_ARGUMENTS_RE = re.compile(r'(?:\[(?:.*?)\])*')
+# The index of the last group matched tells the kind of token: \iffalse or
+# \if0, \iftrue or \if1, any other \if (its spaces and name), \else, \fi.
+_CONDITIONAL_RE = regex.compile(
+    r'(?!(?<=\\newif\s*))\\if(?: *(false|0)(?!\w)| *(true|1)(?!\w)|(\s*)(\w+))'
+    r'|(\\else)(?!\w)|(\\fi)(?!\w)'
+)
+_IFFALSE, _IFTRUE, _IF_UNKNOWN, _ELSE, _FI = 1, 2, 4, 5, 6
+_TIKZ_RE = re.compile(r'\\tikzsetnextfilename{[\s\S]*?\\end{tikzpicture}')
+_TIKZ_FILENAME_RE = re.compile(r'\\tikzsetnextfilename{(.*?)}')
+_INCLUDESVG_RE = re.compile(r'\\includesvg(\[.*?\])?{(.*?)}')
+_INPUT_RE = re.compile(r'\\input\{([^}]+)\}')
+_WORD_CHAR_RE = regex.compile(r'\w')
+_WHITESPACE_RE = regex.compile(r'\s+')
+# The ASCII characters matched by '\s', to strip ASCII text without regex.
+_ASCII_WHITESPACE_TABLE = dict.fromkeys(map(ord, ' \t\n\r\x0b\x0c'))
+# Patterns that refer to groups by number or set global flags, so that their
+# meaning would change if they were combined in one alternation.
+_UNCOMBINABLE_PATTERN_RE = regex.compile(
+    r'\\[1-9]|\\g<\d|\(\?[-+]?\d|\(\?\(\d|\(\?R\)|\(\?[a-zA-Z]+\)'
+)
+# Global inline flags, which change the meaning of the whole user pattern.
+_GLOBAL_FLAGS_RE = regex.compile(r'\(\?[a-zA-Z-]+\)')
+# A '{' that may start a repetition rather than be a literal brace.
+_BRACE_QUANTIFIER_RE = regex.compile(r'\{[\d,\s]*\}')
+# An unescaped brace that regex may read as fuzzy matching constraints, like
+# '{e<=1}' or '{2i+2d+1s<=4}', which make the preceding item approximate.
+_FUZZY_CONSTRAINT_RE = regex.compile(
+    r'(?:^|[^\\])(?:\\\\)*'
+    r'\{[\s\d<=,+eids]*[eids][\s\d<=,+eids]*(?::[^}]*)?\}'
+)
+# Constructs of the user patterns that re and regex both accept, but read
+# differently: character classes with different Unicode definitions and
+# unescaped braces with a letter of the fuzzy matching constraints of regex.
+_REGEX_ONLY_RE = regex.compile(
+    r'(?:^|[^\\])(?:\\\\)*(?:\\[wWbBsS]|\{[^}]*[eids])'
+)
+# Characters with a special meaning in the strict reference patterns.
+_STRICT_SPECIAL_CHARS = frozenset('\\^$*+?{}[]|()')
+
+
+# Folders already created by _create_dir_if_not_exists, so that the ones
+# holding several files are only created once.
+_created_dirs = set()
+
+
 def _create_dir_erase_if_exists(path):
+  _created_dirs.clear()
   if os.path.exists(path):
     shutil.rmtree(path)
   os.makedirs(path)
 
 
 def _create_dir_if_not_exists(path):
-  if not os.path.exists(path):
-    os.makedirs(path)
+  key = os.path.normpath(path)
+  if key in _created_dirs:
+    return
+  os.makedirs(path, exist_ok=True)
+  _created_dirs.add(key)
+
+
+def _get_num_jobs(parameters):
+  """Returns the number of parallel workers, one per CPU by default."""
+  return parameters.get('jobs') or os.cpu_count() or 1
+
+
+def _compile(pattern):
+  """Compiles a user pattern, with the faster re module if it supports it.
+
+  Patterns that re rejects, or warns about since they would mean something
+  else with regex (e.g. nested sets), are compiled with regex. So are the
+  patterns that both accept with different meanings: '\\w', '\\b' and '\\s'
+  classes, whose Unicode definitions differ, and braces that regex may read as
+  fuzzy matching constraints.
+  """
+  if _REGEX_ONLY_RE.search(pattern):
+    return regex.compile(pattern)
+  with warnings.catch_warnings():
+    warnings.simplefilter('error')
+    try:
+      return re.compile(pattern)
+    except (re.error, Warning):
+      pass
+  return regex.compile(pattern)
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_union(patterns):
+  """Compiles a pattern matching any of 'patterns' (none if it is empty)."""
+  if not patterns:
+    return re.compile(r'(?!)')
+  return _compile('|'.join('(?:{})'.format(p) for p in patterns))
 
 
 def _keep_pattern(haystack, patterns_to_keep):
   """Keeps the strings that match 'patterns_to_keep'."""
-  out = []
-  for item in haystack:
-    if any((regex.findall(rem, item) for rem in patterns_to_keep)):
-      out.append(item)
-  return out
+  pattern = _compile_union(tuple(patterns_to_keep))
+  return [item for item in haystack if pattern.search(item)]
 
 
 def _remove_pattern(haystack, patterns_to_remove):
   """Removes the strings that match 'patterns_to_remove'."""
-  return [
-      item
-      for item in haystack
-      if item not in _keep_pattern([item], patterns_to_remove)
-  ]
+  pattern = _compile_union(tuple(patterns_to_remove))
+  return [item for item in haystack if not pattern.search(item)]
+
+
+def _walk_files(folder, prefix=''):
+  """Yields the paths of all files in 'folder', relative to it.
+
+  Uses the same order as os.walk (top-down, not following links to folders).
+  """
+  subfolders = []
+  try:
+    entries = os.scandir(folder)
+  except OSError:
+    # Folders that cannot be read are skipped, like os.walk does.
+    return
+  with entries:
+    for entry in entries:
+      path = os.path.join(prefix, entry.name) if prefix else entry.name
+      if entry.is_dir():
+        if not entry.is_symlink():
+          subfolders.append((entry.path, path))
+      else:
+        yield path
+  for subfolder, path in subfolders:
+    yield from _walk_files(subfolder, path)
 
 
 def _list_all_files(in_folder, ignore_dirs=None):
   if ignore_dirs is None:
     ignore_dirs = []
-  to_consider = [
-      os.path.join(os.path.relpath(path, in_folder), name)
-      if path != in_folder
-      else name
-      for path, _, files in os.walk(in_folder)
-      for name in files
-  ]
-  return _remove_pattern(to_consider, ignore_dirs)
+  return _remove_pattern(list(_walk_files(in_folder)), ignore_dirs)
 
 
 def _copy_file(filename, params):
   _create_dir_if_not_exists(
       os.path.join(params['output_folder'], os.path.dirname(filename))
   )
-  shutil.copy(
+  shutil.copyfile(
       os.path.join(params['input_folder'], filename),
       os.path.join(params['output_folder'], filename),
   )
 
 
-def _remove_command(text, command, keep_text=False):
-  """Removes '\\command{*}' from the string 'text'.
+def _splice(text, replacements):
+  """Replaces the spans of 'text' given as sorted (start, end, new_text).
 
-  Regex `base_pattern` used to match balanced parentheses taken from:
-  https://stackoverflow.com/questions/546433/regular-expression-to-match-balanced-parentheses/35271017#35271017
+  The result is built in a single join, instead of rebuilding the whole text
+  for every replacement.
   """
-  base_pattern = (
-      r'\\'
-      + command
-      + r'(?:\[(?:.*?)\])*\{((?:[^{}]+|\{(?1)\})*)\}(?:\[(?:.*?)\])*'
+  out = []
+  prev_end = 0
+  for start, end, new_text in replacements:
+    out.append(text[prev_end:start])
+    out.append(new_text)
+    prev_end = end
+  if not out:
+    return text
+  out.append(text[prev_end:])
+  return ''.join(out)
+
+
+@functools.lru_cache(maxsize=None)
+def _compiled_command_prefix(commands):
+  """Compiles the pattern matching '\\command[*]{' for any of 'commands'."""
+  return _compile(
+      r'\\(?:'
+      + '|'.join('(?:' + command + ')' for command in commands)
+      + r')(?:\[(?:.*?)\])*\{'
   )
 
-  def extract_text_inside_curly_braces(text):
-    """Extract text inside of {} from command string"""
-    pattern = r'\{((?:[^{}]|(?R))*)\}'
 
-    match = regex.search(pattern, text)
+def _find_closing_brace(text, open_pos):
+  """Returns the position of the '}' closing the '{' at 'open_pos', or -1.
 
-    if match:
-      return match.group(1)
+  Escaped characters such as '\\{' and '\\}' are skipped.
+  """
+  depth = 0
+  for match in _BRACE_TOKEN_RE.finditer(text, open_pos):
+    token = match.group()
+    if token == '{':
+      depth += 1
+    elif token == '}':
+      depth -= 1
+      if depth == 0:
+        return match.start()
+  return -1
+
+
+def _remove_commands(text, commands, keep_text=False):
+  """Removes '\\command{*}' from the string 'text' for all 'commands' at once."""
+  if not commands:
+    return text
+  prefix_pattern = _compiled_command_prefix(tuple(commands))
+
+  replacements = []
+  match = prefix_pattern.search(text)
+  while match:
+    close = _find_closing_brace(text, match.end() - 1)
+    if close == -1:
+      match = prefix_pattern.search(text, match.start() + 1)
+      continue
+    end = _OPTIONAL_ARGUMENTS_RE.match(text, close + 1).end()
+
+    if keep_text:
+      # Recurses in case of nested commands that need to retain text, e.g.,
+      # \red{hello \red{world}}.
+      new_substring = _remove_commands(
+          text[match.end() : close], commands, keep_text
+      )
     else:
-      return ''
+      # In case there are only spaces or nothing up to the following
+      # newline, adds a percent, not to alter the newlines.
+      new_substring = ''
+      next_newline = text.find('\n', end)
+      if next_newline != -1 and not text[end:next_newline].strip():
+        new_substring = '%'
+    replacements.append((match.start(), end, new_substring))
+    match = prefix_pattern.search(text, end)
 
-  # Loops in case of nested commands that need to retain text, e.g.,
-  # \red{hello \red{world}}.
-  while True:
-    all_substitutions = []
-    has_match = False
-    for match in regex.finditer(base_pattern, text):
-      # In case there are only spaces or nothing up to the following newline,
-      # adds a percent, not to alter the newlines.
-      has_match = True
-
-      if not keep_text:
-        new_substring = ''
-      else:
-        temp_substring = text[match.span()[0] : match.span()[1]]
-        new_substring = extract_text_inside_curly_braces(temp_substring)
-
-      if match.span()[1] < len(text):
-        next_newline = text[match.span()[1] :].find('\n')
-        if next_newline != -1:
-          text_until_newline = text[
-              match.span()[1] : match.span()[1] + next_newline
-          ]
-          if (
-              not text_until_newline or text_until_newline.isspace()
-          ) and not keep_text:
-            new_substring = '%'
-      all_substitutions.append(
-          (match.span()[0], match.span()[1], new_substring)
-      )
+  return _splice(text, replacements)
 
-    for start, end, new_substring in reversed(all_substitutions):
-      text = text[:start] + new_substring + text[end:]
 
-    if not keep_text or not has_match:
-      break
+def _remove_command(text, command, keep_text=False):
+  """Removes '\\command{*}' from the string 'text'."""
+  return _remove_commands(text, (command,), keep_text)
 
-  return text
+
+@functools.lru_cache(maxsize=None)
+def _compiled_remove_environment(environment):
+  # Need to escape '{', to not trigger fuzzy matching in regex if
+  # `environment` starts with one of 'i', 'd', 's', or 'e'
+  return _compile(
+      r'\\begin\{' + environment + r'}(?s:.*?)\\end\{' + environment + r'}'
+  )
 
 
 def _remove_environment(text, environment):
   """Removes '\\begin{environment}*\\end{environment}' from 'text'."""
-  # Need to escape '{', to not trigger fuzzy matching if `environment` starts
-  # with one of 'i', 'd', 's', or 'e'
-  return regex.sub(
-      r'\\begin\{' + environment + r'}[\s\S]*?\\end\{' + environment + r'}',
-      '',
-      text,
-  )
+  return _compiled_remove_environment(environment).sub('', text)
+
+
+# Conditionals that are not \if...\else...\fi blocks, never simplified.
+_BUILTIN_IF_EXCEPTIONS = frozenset([
+    # TeX primitives
+    'iff',
+    # package etoolbox
+    'ifpatchable',
+    'ifpatchable*',
+    'ifbool',
+    'iftoggle',
+    'ifdef',
+    'ifcsdef',
+    'ifundef',
+    'ifcsundef',
+    'ifdefmacro',
+    'ifcsmacro',
+    'ifdefparam',
+    'ifcsparam',
+    'ifcsprefix',
+    'ifdefprotected',
+    'ifcsprotected',
+    'ifdefltxprotect',
+    'ifcsltxprotect',
+    'ifdefempty',
+    'ifcsempty',
+    'ifdefvoid',
+    'ifcsvoid',
+    'ifdefequal',
+    'ifcsequal',
+    'ifdefstring',
+    'ifcsstring',
+    'ifdefstrequal',
+    'ifcsstrequal',
+    'ifdefcounter',
+    'ifcscounter',
+    'ifltxcounter',
+    'ifdeflength',
+    'ifcslength',
+    'ifdefdimen',
+    'ifcsdimen',
+    'ifstrequal',
+    'ifstrempty',
+    'ifblank',
+    'ifnumcomp',
+    'ifnumequal',
+    'ifnumodd',
+    'ifdimcomp',
+    'ifdimequal',
+    'ifdimgreater',
+    'ifdimless',
+    'ifboolexpr',
+    'ifboolexpe',
+    'ifinlist',
+    'ifinlistcs',
+    'ifrmnum',
+    # package hyperref
+    'ifpdfstringunicode',
+    # package ifthen
+    'ifthenelse',
+])
+
+
+class _ConditionalNode:
+  """A conditional block, with the blocks nested in each of its branches."""
+
+  __slots__ = ('kind', 'start', 'else_m', 'end', 'left', 'right', 'parent')
+
+  def __init__(self, kind, start=None, parent=None):
+    self.kind = kind
+    self.start = start
+    self.else_m = None
+    self.end = None
+    self.left = []
+    self.right = []
+    self.parent = parent
 
 
 def _simplify_conditional_blocks(text, if_exceptions=[]):
@@ -187,91 +398,31 @@ def _simplify_conditional_blocks(text, if_exceptions=[]):
   If the conditional tree is malformed, the function will print a warning
   to stderr and return the original text.
   """
-  p = regex.compile(r'(?!(?<=\\newif\s*))\\if\s*(\w+)|\\else(?!\w)|\\fi(?!\w)')
-  toplevel_tree = {'left': [], 'right': [], 'kind': 'toplevel', 'parent': None}
+  toplevel_tree = _ConditionalNode('toplevel')
 
   tree = toplevel_tree
 
-  exceptions = [
-      # TeX primitives
-      'iff',
-      # package etoolbox
-      'ifpatchable',
-      'ifpatchable*',
-      'ifbool',
-      'iftoggle',
-      'ifdef',
-      'ifcsdef',
-      'ifundef',
-      'ifcsundef',
-      'ifdefmacro',
-      'ifcsmacro',
-      'ifdefparam',
-      'ifcsparam',
-      'ifcsprefix',
-      'ifdefprotected',
-      'ifcsprotected',
-      'ifdefltxprotect',
-      'ifcsltxprotect',
-      'ifdefempty',
-      'ifcsempty',
-      'ifdefvoid',
-      'ifcsvoid',
-      'ifdefequal',
-      'ifcsequal',
-      'ifdefstring',
-      'ifcsstring',
-      'ifdefstrequal',
-      'ifcsstrequal',
-      'ifdefcounter',
-      'ifcscounter',
-      'ifltxcounter',
-      'ifdeflength',
-      'ifcslength',
-      'ifdefdimen',
-      'ifcsdimen',
-      'ifstrequal',
-      'ifstrempty',
-      'ifblank',
-      'ifnumcomp',
-      'ifnumequal',
-      'ifnumodd',
-      'ifdimcomp',
-      'ifdimequal',
-      'ifdimgreater',
-      'ifdimless',
-      'ifboolexpr',
-      'ifboolexpe',
-      'ifinlist',
-      'ifinlistcs',
-      'ifrmnum',
-      # package hyperref
-      'ifpdfstringunicode',
-      # package ifthen
-      'ifthenelse',
-  ] + if_exceptions
-
-  def new_subtree(kind):
-    return {'kind': kind, 'left': [], 'right': []}
-
-  def add_subtree(tree, subtree):
-    if 'else' not in tree:
-      tree['left'].append(subtree)
+  exceptions = _BUILTIN_IF_EXCEPTIONS.union(if_exceptions)
+
+  def add_subtree(tree, kind, start):
+    subtree = _ConditionalNode(kind, start, tree)
+    if tree.else_m is None:
+      tree.left.append(subtree)
     else:
-      tree['right'].append(subtree)
-    subtree['parent'] = tree
+      tree.right.append(subtree)
+    return subtree
 
   def print_tree(tree, indent, write):
-    if 'start' in tree:
-      write(' ' * indent + tree['start'].group() + '\n')
-    for subtree in tree['left']:
+    if tree.start is not None:
+      write(' ' * indent + tree.start.group() + '\n')
+    for subtree in tree.left:
       print_tree(subtree, indent + 2, write)
-    if 'else' in tree:
-      write(' ' * indent + tree['else'].group() + '\n')
-    for subtree in tree['right']:
-      print_tree(subtree, indent + 2)
-    if 'end' in tree:
-      write(' ' * indent + tree['end'].group() + '\n')
+    if tree.else_m is not None:
+      write(' ' * indent + tree.else_m.group() + '\n')
+    for subtree in tree.right:
+      print_tree(subtree, indent + 2, write)
+    if tree.end is not None:
+      write(' ' * indent + tree.end.group() + '\n')
 
   def print_abort(error_finding):
     os.sys.stderr.write(
@@ -287,155 +438,201 @@ def _simplify_conditional_blocks(text, if_exceptions=[]):
         f" --if_exceptions'.\n"
     )
 
-  for m in p.finditer(text):
-    m_no_space = m.group().replace(' ', '')
-    if m_no_space == r'\iffalse' or m_no_space == r'\if0':
-      subtree = new_subtree('iffalse')
-      subtree['start'] = m
-      add_subtree(tree, subtree)
-      tree = subtree
-    elif m_no_space == r'\iftrue' or m_no_space == r'\if1':
-      subtree = new_subtree('iftrue')
-      subtree['start'] = m
-      add_subtree(tree, subtree)
-      tree = subtree
-    elif m_no_space.startswith(r'\if'):
-      if m_no_space[1:] in exceptions:
+  for m in _CONDITIONAL_RE.finditer(text):
+    token = m.lastindex
+    if token == _IFFALSE:
+      tree = add_subtree(tree, 'iffalse', m)
+    elif token == _IFTRUE:
+      tree = add_subtree(tree, 'iftrue', m)
+    elif token == _IF_UNKNOWN:
+      if 'if' + m.group(3).replace(' ', '') + m.group(4) in exceptions:
         continue
-      subtree = new_subtree('unknown')
-      subtree['start'] = m
-      add_subtree(tree, subtree)
-      tree = subtree
-    elif m_no_space == r'\else':
-      if tree['parent'] is None:
+      tree = add_subtree(tree, 'unknown', m)
+    elif token == _ELSE:
+      if tree.parent is None:
         print_abort(r'unmatched \else')
         return text
-      elif 'else' in tree:
+      elif tree.else_m is not None:
         print_abort(r'duplicate \else')
         return text
 
-      tree['else'] = m
-    elif m.group() == r'\fi':
-      if tree['parent'] is None:
+      tree.else_m = m
+    elif token == _FI:
+      if tree.parent is None:
         print_abort(r'unmatched \fi')
         return text
 
-      tree['end'] = m
-      tree = tree['parent']
+      tree.end = m
+      tree = tree.parent
     else:
       raise RuntimeError('Unreachable!')
 
-  if tree['parent'] is not None:
-    print_abort('unmatched ' + tree['start'].group())
+  if tree.parent is not None:
+    print_abort('unmatched ' + tree.start.group())
     return text
 
   positions_to_delete = []
 
   def traverse_tree(tree):
-    if tree['kind'] == 'iffalse':
-      if 'else' in tree:
-        positions_to_delete.append((tree['start'].start(), tree['else'].end()))
-        for subtree in tree['right']:
+    if tree.kind == 'iffalse':
+      if tree.else_m is not None:
+        positions_to_delete.append((tree.start.start(), tree.else_m.end()))
+        for subtree in tree.right:
           traverse_tree(subtree)
-        positions_to_delete.append((tree['end'].start(), tree['end'].end()))
+        positions_to_delete.append((tree.end.start(), tree.end.end()))
       else:
-        positions_to_delete.append((tree['start'].start(), tree['end'].end()))
-    elif tree['kind'] == 'iftrue':
-      if 'else' in tree:
-        positions_to_delete.append((tree['start'].start(), tree['start'].end()))
-        for subtree in tree['left']:
+        positions_to_delete.append((tree.start.start(), tree.end.end()))
+    elif tree.kind == 'iftrue':
+      if tree.else_m is not None:
+        positions_to_delete.append((tree.start.start(), tree.start.end()))
+        for subtree in tree.left:
           traverse_tree(subtree)
-        positions_to_delete.append((tree['else'].start(), tree['end'].end()))
+        positions_to_delete.append((tree.else_m.start(), tree.end.end()))
       else:
-        positions_to_delete.append((tree['start'].start(), tree['start'].end()))
-        positions_to_delete.append((tree['end'].start(), tree['end'].end()))
-    elif tree['kind'] == 'unknown':
-      for subtree in tree['left']:
+        positions_to_delete.append((tree.start.start(), tree.start.end()))
+        positions_to_delete.append((tree.end.start(), tree.end.end()))
+    elif tree.kind == 'unknown':
+      for subtree in tree.left:
         traverse_tree(subtree)
-      for subtree in tree['right']:
+      for subtree in tree.right:
         traverse_tree(subtree)
     else:
       raise ValueError('Unreachable!')
 
-  for tree in toplevel_tree['left']:
+  for tree in toplevel_tree.left:
     traverse_tree(tree)
 
+  # Each deletion also removes the whitespace character that follows it once
+  # the deletions after it are applied, so adjacent deletions are merged while
+  # walking them backwards. The text is then rebuilt in a single pass.
+  spans_to_delete = []
   for start, end in reversed(positions_to_delete):
+    if spans_to_delete and spans_to_delete[-1][0] == end:
+      end = spans_to_delete.pop()[1]
     if end < len(text) and text[end].isspace():
-      end_to_del = end + 1
-    else:
-      end_to_del = end
-    text = text[:start] + text[end_to_del:]
+      end += 1
+      if spans_to_delete and spans_to_delete[-1][0] == end:
+        end = spans_to_delete.pop()[1]
+    spans_to_delete.append((start, end))
 
-  return text
+  return _splice(
+      text, ((start, end, '') for start, end in reversed(spans_to_delete))
+  )
 
 
-def _remove_comments_inline(text):
-  """Removes the comments from the string 'text' and ignores % inside \\url{}."""
-  auto_ignore_pattern = r'(%\s*auto-ignore).*'
-  if regex.search(auto_ignore_pattern, text):
-    return regex.sub(auto_ignore_pattern, r'\1', text)
+def _find_url_end(text, start, line_end):
+  """Returns the end of the '\\url{}' starting at 'start', or -1 if unclosed.
 
-  if text.lstrip(' ').lstrip('\t').startswith('%'):
-    return ''
+  The url argument cannot contain braces, nor span more than one line.
+  """
+  close = text.find('}', start + len('\\url{'), line_end)
+  if close == -1 or text.find('{', start + len('\\url{'), close) != -1:
+    return -1
+  return close + 1
 
-  url_pattern = r'\\url\{(?>[^{}]|(?R))*\}'
 
-  def remove_comments(segment):
-    """Check if a segment of text contains a comment and remove it."""
-    if segment.lstrip().startswith('%'):
-      return '', True
-    match = regex.search(r'(?<!\\)%', segment)
-    if match:
-      return segment[: match.end()] + '\n', True
-    else:
-      return segment, False
+def _find_comment(text, start, line_end):
+  """Returns the position of the first unescaped '%' of the line, or -1."""
+  percent = text.find('%', start, line_end)
+  while percent > start and text[percent - 1] == '\\':
+    percent = text.find('%', percent + 1, line_end)
+  return percent
 
-  # split the text into segments based on \url{} tags
-  segments = regex.split(f'({url_pattern})', text)
 
-  for i in range(len(segments)):
-    # only process segments that are not part of a \url{} tag
-    if not regex.match(url_pattern, segments[i]):
-      segments[i], match = remove_comments(segments[i])
+def _strip_comments(text):
+  """Removes the comments from the string 'text' and ignores % inside \\url{}.
+
+  The text is scanned once, line by line, without splitting it: lines marked
+  with '% auto-ignore' are kept up to the marker, lines starting with '%' are
+  dropped, and other comments are cut right after their '%'.
+  """
+  out = []
+  check_auto_ignore = 'auto-ignore' in text
+  pos = 0
+  while pos < len(text):
+    line_end = text.find('\n', pos)
+    if line_end == -1:
+      line_end = next_line = len(text)
+    else:
+      next_line = line_end + 1
+
+    if check_auto_ignore:
+      match = _AUTO_IGNORE_RE.search(text, pos, line_end)
       if match:
-        # remove all segments after the first inline comment
-        segments = segments[: i + 1]
-        break
+        out.append(text[pos : match.end(1)])
+        out.append(text[line_end:next_line])
+        pos = next_line
+        continue
+
+    first = pos
+    while text.startswith(' ', first):
+      first += 1
+    while text.startswith('\t', first):
+      first += 1
+    if text.startswith('%', first):
+      pos = next_line
+      continue
+
+    # Skips the \url{} tags appearing before the first comment of the line.
+    segment_start = pos
+    percent = _find_comment(text, pos, line_end)
+    url = text.find('\\url{', pos, line_end if percent == -1 else percent)
+    while url != -1:
+      url_end = _find_url_end(text, url, line_end)
+      if url_end == -1:
+        search_from = url + 1
+      else:
+        segment_start = search_from = url_end
+        if percent != -1 and percent < url_end:
+          percent = _find_comment(text, url_end, line_end)
+      url = text.find(
+          '\\url{', search_from, line_end if percent == -1 else percent
+      )
+
+    if percent == -1:
+      line = text[pos:next_line]
+    elif not text[segment_start:percent].strip():
+      line = text[pos:segment_start]
+    else:
+      line = text[pos : percent + 1] + '\n'
+    if not (line.endswith('\n') or line.endswith('\\n')):
+      line += '\n'
+    out.append(line)
+    pos = next_line
+  return ''.join(out)
 
-  final_text = ''.join(segments)
-  return (
-      final_text
-      if final_text.endswith('\n') or final_text.endswith('\\n')
-      else final_text + '\n'
-  )
 
+def _remove_comments_inline(text):
+  """Removes the comments from the single line 'text'."""
+  return _strip_comments(text)
 
-def _strip_tex_contents(lines, end_str):
-  """Removes everything after end_str."""
-  for i in range(len(lines)):
-    if end_str in lines[i]:
-      if '%' not in lines[i]:
-        return lines[: i + 1]
-      elif lines[i].index('%') > lines[i].index(end_str):
-        return lines[: i + 1]
-  return lines
+
+def _strip_tex_contents(text, end_str):
+  """Removes everything after the line where end_str is not commented out."""
+  start = 0
+  while True:
+    position = text.find(end_str, start)
+    if position < 0:
+      return text
+    line_start = text.rfind('\n', 0, position) + 1
+    line_end = text.find('\n', position) + 1 or len(text)
+    comment = text.find('%', line_start, line_end)
+    if comment < 0 or comment > position:
+      return text[:line_end]
+    start = line_end
 
 
 def _read_file_content(filename):
   with open(filename, 'r', encoding='utf-8') as fp:
-    lines = fp.readlines()
-    lines = _strip_tex_contents(lines, '\\end{document}')
-    return lines
+    return _strip_tex_contents(fp.read(), '\\end{document}')
 
 
 def _read_all_tex_contents(tex_files, parameters):
-  contents = {}
-  for fn in tex_files:
-    contents[fn] = _read_file_content(
-        os.path.join(parameters['input_folder'], fn)
-    )
-  return contents
+  input_folder = parameters['input_folder']
+  return {
+      fn: _read_file_content(os.path.join(input_folder, fn))
+      for fn in tex_files
+  }
 
 
 def _write_file_content(content, filename):
@@ -446,20 +643,45 @@ def _write_file_content(content, filename):
 
 def _remove_comments_and_commands_to_delete(content, parameters):
   """Erases all LaTeX comments in the content, and writes it."""
-  content = [_remove_comments_inline(line) for line in content]
-  content = _remove_environment(''.join(content), 'comment')
+  content = _strip_comments(content)
+  content = _remove_environment(content, 'comment')
   content = _simplify_conditional_blocks(
       content, parameters.get('if_exceptions', [])
   )
   for environment in parameters.get('environments_to_delete', []):
     content = _remove_environment(content, environment)
-  for command in parameters.get('commands_only_to_delete', []):
-    content = _remove_command(content, command, True)
-  for command in parameters['commands_to_delete']:
-    content = _remove_command(content, command, False)
+  content = _remove_commands(
+      content, parameters.get('commands_only_to_delete', []), True
+  )
+  content = _remove_commands(content, parameters['commands_to_delete'], False)
   return content
 
 
+def _clean_tex_file(args):
+  """Removes comments and replaces svg and tikz figures in one tex file.
+
+  Takes and returns tuples, to be mapped over a process pool.
+  """
+  tex_file, content, parameters, svg_inkscape, external_tikz_figures = args
+  logging.info('Removing comments in file %s.', tex_file)
+  content = _remove_comments_and_commands_to_delete(content, parameters)
+  logging.info('Replacing \\includesvg calls in file %s.', tex_file)
+  content = _replace_includesvg(content, svg_inkscape)
+  logging.info('Replacing Tikz Pictures in file %s.', tex_file)
+  content = _replace_tikzpictures(content, external_tikz_figures)
+  return tex_file, content
+
+
+def _replace_patterns_in_tex_file(args):
+  """Replaces the user patterns in one tex file.
+
+  Takes and returns tuples, to be mapped over a process pool.
+  """
+  tex_file, content, patterns_and_insertions = args
+  logging.info('Replacing patterns in file %s.', tex_file)
+  return tex_file, _find_and_replace_patterns(content, patterns_and_insertions)
+
+
 def _replace_tikzpictures(content, figures):
   """Replaces all tikzpicture environments (with includegraphic commands of
 
@@ -467,9 +689,7 @@ def _replace_tikzpictures(content, figures):
   """
 
   def get_figure(matchobj):
-    found_tikz_filename = regex.search(
-        r'\\tikzsetnextfilename{(.*?)}', matchobj.group(0)
-    ).group(1)
+    found_tikz_filename = _TIKZ_FILENAME_RE.search(matchobj.group(0)).group(1)
     # search in tex split if figure is available
     matching_tikz_filenames = _keep_pattern(
         figures, ['/' + found_tikz_filename + '.pdf']
@@ -479,9 +699,7 @@ def _replace_tikzpictures(content, figures):
     else:
       return matchobj.group(0)
 
-  content = regex.sub(
-      r'\\tikzsetnextfilename{[\s\S]*?\\end{tikzpicture}', get_figure, content
-  )
+  content = _TIKZ_RE.sub(get_figure, content)
 
   return content
 
@@ -504,7 +722,7 @@ def _replace_includesvg(content, svg_inkscape_files):
     else:
       return matchobj.group(0)
 
-  content = regex.sub(r'\\includesvg(\[.*?\])?{(.*?)}', repl_svg, content)
+  content = _INCLUDESVG_RE.sub(repl_svg, content)
 
   return content
 
@@ -520,40 +738,35 @@ def _resize_and_copy_figure(
     png_to_jpg_compress=False,
 ):
   """Resizes and copies the input figure (either JPG, PNG, or PDF)."""
-  _create_dir_if_not_exists(
-      os.path.join(destination_folder, os.path.dirname(filename))
-  )
-
-  if resize_image and os.path.splitext(filename)[1].lower() in [
-      '.jpg',
-      '.jpeg',
-      '.png',
-  ]:
-    im = Image.open(os.path.join(origin_folder, filename))
+  root, ext = os.path.splitext(filename)
+  ext = ext.lower()
+  src = os.path.join(origin_folder, filename)
+  dst = os.path.join(destination_folder, filename)
+  _create_dir_if_not_exists(os.path.dirname(dst))
+
+  if resize_image and ext in _RASTER_EXTS:
+    im = Image.open(src)
     if max(im.size) > image_size:
       im = im.resize(
           tuple([int(x * float(image_size) / max(im.size)) for x in im.size]),
           Image.Resampling.LANCZOS,
       )
-    if os.path.splitext(filename)[1].lower() in ['.jpg', '.jpeg']:
-      im.save(os.path.join(destination_folder, filename), 'JPEG', quality=90)
-    elif os.path.splitext(filename)[1].lower() in ['.png'] and not png_to_jpg_compress:
-      im.save(os.path.join(destination_folder, filename), 'PNG')
-    elif os.path.splitext(filename)[1].lower() in ['.png'] and png_to_jpg_compress:
-      new_filename = os.path.splitext(filename)[0] + ".jpg"
+    if ext in _JPEG_EXTS:
+      im.save(dst, 'JPEG', quality=90)
+    elif not png_to_jpg_compress:
+      im.save(dst, 'PNG')
+    else:
+      new_filename = root + ".jpg"
       im = im.convert("RGB")  # Convert PNG to RGB (to support JPEG format)
       im.save(os.path.join(destination_folder, new_filename), 'JPEG', quality=90)
 
 
-  elif compress_pdf and os.path.splitext(filename)[1].lower() == '.pdf':
+  elif compress_pdf and ext == '.pdf':
     _resize_pdf_figure(
         filename, origin_folder, destination_folder, pdf_resolution
     )
   else:
-    shutil.copy(
-        os.path.join(origin_folder, filename),
-        os.path.join(destination_folder, filename),
-    )
+    shutil.copyfile(src, dst)
 
 
 def _resize_pdf_figure(
@@ -571,6 +784,8 @@ def _resize_pdf_figure(
   except subprocess.TimeoutExpired:
     process.kill()
     outs, errs = process.communicate()
+    # Several figures are compressed concurrently, so tells which one failed.
+    print(f'Timed out compressing {input_file}.')
     print('Output: ', outs)
     print('Errors: ', errs)
 
@@ -581,48 +796,97 @@ def _copy_only_referenced_non_tex_not_in_root(parameters, contents, splits):
   ):
     _copy_file(fn, parameters)
 
+def _find_input_file(filename, tex_files, index):
+  """Returns the tex file that '\\input{filename}' refers to, or None."""
+  if filename in index:
+    return index[filename]
+  file = [fn for fn in tex_files if filename in fn]
+  if len(file) > 1:
+    file = [fn for fn in tex_files if filename + '.tex' in fn]
+  if len(file) == 0:  # no match
+    return None
+  assert len(file) == 1
+  return file[0]
+
+
 def _flat_latex(parameters, contents, splits):
-    main_content = _read_file_content(os.path.join(parameters['output_folder'], parameters['main_tex']))
-    def remove_empty_dirs(file_path):
-        folder_path = os.path.dirname(file_path)
-        if not os.listdir(folder_path):  # If empty, remove it
-            os.rmdir(folder_path)
-            remove_empty_dirs(folder_path)
-    while True:
-        processed_content = []
-        added_flag = False
-
-        for line in main_content:
-            match = regex.search(r'\\input\{([^}]+)\}', line)
-            if not match:
-                processed_content.append(line)
-                continue
-            filename = match.group(1)
-            file = [fn for fn in splits['tex_to_copy'] if filename in fn]
-            if len(file) > 1:
-                file = [fn for fn in splits['tex_to_copy'] if filename + '.tex' in fn]
-            if len(file) == 0: # no match
-                logging.error(f'Missing match to : {filename} ; in : {splits["tex_to_copy"]}')
-                logging.error(f'Line: {line}')
-                processed_content.append(line)
-                continue
-            assert len(file)==1
-            fn = file[0]
-            added_flag = True
-            file_path = os.path.join(parameters['output_folder'], fn)
-            inserted_content = _read_file_content(file_path)
-            processed_content.extend(inserted_content)
-            os.remove(file_path)
-            remove_empty_dirs(file_path)
-        main_content = processed_content.copy()
-        if not added_flag:
-            break
-        # if not '\input{' in ''.join():
-        #     break
-    _write_file_content(
-        ''.join(main_content),
-        os.path.join(parameters['output_folder'], parameters['main_tex']),
-    )
+  """Replaces every '\\input' line of the main file by the file it refers to.
+
+  Inputs are expanded recursively in a single pass, every file being read
+  once; the inlined files are removed at the end.
+  """
+  tex_files = splits['tex_to_copy']
+  files_by_stem = collections.defaultdict(list)
+  for fn in tex_files:
+    files_by_stem[os.path.splitext(fn)[0]].append(fn)
+  # Stems shared by several files (e.g. a .tex and a .tikz one) are left to
+  # _find_input_file, which prefers the .tex file.
+  index = {
+      stem: fns[0] for stem, fns in files_by_stem.items() if len(fns) == 1
+  }
+  for fn in tex_files:
+    index[fn] = fn
+  file_contents = {}
+  inlined_files = set()
+
+  def read_content(fn):
+    if fn not in file_contents:
+      file_contents[fn] = _read_file_content(
+          os.path.join(parameters['output_folder'], fn)
+      )
+    return file_contents[fn]
+
+  def expand(text, being_expanded):
+    processed_content = []
+    lines = text.split('\n')
+    for i, line in enumerate(lines):
+      if i < len(lines) - 1:
+        line += '\n'
+      match = _INPUT_RE.search(line)
+      if not match:
+        processed_content.append(line)
+        continue
+      filename = match.group(1)
+      fn = _find_input_file(filename, tex_files, index)
+      if fn is None:
+        logging.error(f'Missing match to : {filename} ; in : {tex_files}')
+        logging.error(f'Line: {line}')
+        processed_content.append(line)
+        continue
+      if fn in being_expanded:
+        logging.error(f'Recursive input of : {fn}')
+        logging.error(f'Line: {line}')
+        processed_content.append(line)
+        continue
+      inlined_files.add(fn)
+      being_expanded.add(fn)
+      processed_content.append(expand(read_content(fn), being_expanded))
+      being_expanded.remove(fn)
+    return ''.join(processed_content)
+
+  main_content = expand(
+      read_content(parameters['main_tex']), {parameters['main_tex']}
+  )
+
+  touched_dirs = set()
+  for fn in sorted(inlined_files):
+    os.remove(os.path.join(parameters['output_folder'], fn))
+    folder = os.path.dirname(fn)
+    while folder and folder not in touched_dirs:
+      touched_dirs.add(folder)
+      folder = os.path.dirname(folder)
+  # Deepest folders first, so that a folder is emptied before its parent.
+  for folder in sorted(touched_dirs, key=lambda f: f.count(os.sep), reverse=True):
+    folder_path = os.path.join(parameters['output_folder'], folder)
+    try:
+      os.rmdir(folder_path)  # Fails if the folder is not empty.
+    except OSError:
+      continue
+    _created_dirs.discard(os.path.normpath(folder_path))
+  _write_file_content(
+      main_content,
+      os.path.join(parameters['output_folder'], parameters['main_tex']),
+  )
 
 
 def _resize_and_copy_figures_if_referenced(parameters, contents, splits, strict=False):
@@ -632,9 +896,17 @@ def _resize_and_copy_figures_if_referenced(parameters, contents, splits, strict=
       lambda: parameters['pdf_im_resolution']
   )
   pdf_resolution.update(parameters['images_allowlist'])
-  for image_file in _keep_only_referenced(
+  image_files = _keep_only_referenced(
       splits['figures'], contents, strict=strict
-  ):
+  )
+  # Creates the destination folders beforehand, so that the workers do not
+  # race to create the same folder.
+  for folder in {os.path.dirname(image_file) for image_file in image_files}:
+    _create_dir_if_not_exists(
+        os.path.join(parameters['output_folder'], folder)
+    )
+
+  def resize_and_copy_figure(image_file):
     _resize_and_copy_figure(
         filename=image_file,
         origin_folder=parameters['input_folder'],
@@ -646,12 +918,23 @@ def _resize_and_copy_figures_if_referenced(parameters, contents, splits, strict=
         png_to_jpg_compress=parameters['png_to_jpg_compress']
     )
 
-
-def _search_reference(filename, contents, strict=False):
-  """Returns a match object if filename is referenced in contents, and None otherwise.
-
-  If not strict mode, path prefix and extension are optional.
-  """
+  # Resizing is done by PIL and ghostscript, which do not hold the GIL. Each
+  # figure is reaped as soon as it is done, and any error is raised.
+  with concurrent.futures.ThreadPoolExecutor(
+      max_workers=min(MAX_FIGURE_WORKERS, _get_num_jobs(parameters))
+  ) as executor:
+    futures = {
+        executor.submit(resize_and_copy_figure, image_file): image_file
+        for image_file in image_files
+    }
+    for future in concurrent.futures.as_completed(futures):
+      future.result()
+      logging.info('Copied figure %s.', futures[future])
+
+
+@functools.lru_cache(maxsize=None)
+def _reference_pattern(filename, strict):
+  """Returns the pattern matching a reference to filename in a tex file."""
   if strict:
     # regex pattern for strict=True for path/to/img.ext:
     # \{[\s%]*path/to/img\.ext[\s%]*\}
@@ -687,8 +970,64 @@ def _search_reference(filename, contents, strict=False):
   patn = r'\{{[\s%]*{}[\s%]*\}}'.format(filename_regex)
   if strict: # make optional {} over file_name (relevant to strict=True for figs with log file)
     patn = r'(\{{)?[\s%]*{}[\s%]*(\}})?'.format(filename_regex)
+  return patn
+
+
+@functools.lru_cache(maxsize=None)
+def _compiled_reference(filename, strict):
   # Picture references in LaTeX are allowed to be in different cases.
-  return regex.search(patn, contents, regex.IGNORECASE)
+  return regex.compile(_reference_pattern(filename, strict), regex.IGNORECASE)
+
+
+def _build_automaton(words):
+  """Returns an Aho-Corasick automaton reporting each of 'words'."""
+  automaton = ahocorasick.Automaton()
+  for word in words:
+    automaton.add_word(word, word)
+  automaton.make_automaton()
+  return automaton
+
+
+def _required_literal(filename, strict):
+  """Returns a text that every reference to filename contains, if any.
+
+  It is casefolded, as references are searched ignoring case.
+  """
+  literal = pathlib.Path(filename).stem
+  if strict and any(c in _STRICT_SPECIAL_CHARS for c in filename):
+    return None
+  if not literal or not literal.isascii():
+    return None
+  return literal.casefold()
+
+
+def _filter_candidate_references(filenames, contents, strict):
+  """Drops the filenames whose required literal does not appear in contents.
+
+  This is only a prefilter run with an Aho-Corasick automaton when
+  'ahocorasick' is installed; the references are then checked with regex.
+  """
+  if ahocorasick is None:
+    return filenames
+  literals = {fn: _required_literal(fn, strict) for fn in filenames}
+  words = {literal for literal in literals.values() if literal is not None}
+  if not words:
+    return filenames
+  automaton = _build_automaton(words)
+  found = {word for _, word in automaton.iter(contents.casefold())}
+  return tuple(
+      fn
+      for fn in filenames
+      if literals[fn] is None or literals[fn] in found
+  )
+
+
+def _search_reference(filename, contents, strict=False):
+  """Returns a match object if filename is referenced in contents, and None otherwise.
+
+  If not strict mode, path prefix and extension are optional.
+  """
+  return _compiled_reference(filename, strict).search(contents)
 
 
 def _keep_only_referenced(filenames, contents, strict=False):
@@ -696,37 +1035,78 @@ def _keep_only_referenced(filenames, contents, strict=False):
 
   If not strict mode, path prefix and extension are optional.
   """
+  candidates = set(
+      _filter_candidate_references(
+          tuple(dict.fromkeys(filenames)), contents, strict
+      )
+  )
   return [
       fn
       for fn in filenames
-      if _search_reference(fn, contents, strict) is not None
+      if fn in candidates
+      and _search_reference(fn, contents, strict) is not None
   ]
 
 
+@functools.lru_cache(maxsize=None)
+def _compiled_tex_references(stems):
+  """Compiles the pattern matching a reference to any of the tex 'stems'."""
+  return regex.compile(
+      r'(?<!\w)(' + '|'.join(regex.escape(stem) for stem in stems) + r')[.}]'
+  )
+
+
+def _find_tex_references(text, pattern, automaton=None):
+  """Returns the tex stems referenced in text.
+
+  A stem is referenced when it is not preceded by a word character and is
+  followed by '.' or '}'. Only the longest stem is kept at each position, as
+  'pattern' does with its alternation sorted longest first.
+  """
+  if automaton is None:
+    return set(pattern.findall(text, overlapped=True))
+  longest = {}
+  for end, stem in automaton.iter(text):
+    start = end - len(stem) + 1
+    if end + 1 >= len(text) or text[end + 1] not in '.}':
+      continue
+    if start > 0 and _WORD_CHAR_RE.match(text, start - 1):
+      continue
+    if len(stem) > len(longest.get(start, '')):
+      longest[start] = stem
+  return set(longest.values())
+
+
 def _keep_only_referenced_tex(contents, splits, start_with=None):
   """Returns the filenames referenced from the tex files themselves.
 
-  It needs various iterations in case one file is referenced from an
-  unreferenced file.
+  Each file is scanned once for references to all the tex files, and the
+  files reachable from the starting ones are then collected with a worklist,
+  in case one file is referenced from another referenced file.
   """
-  old_referenced = set(splits['tex_in_root'] + splits['tex_not_in_root'])
-  prev_referenced = {}
-  referenced = {start_with} if start_with is not None else set(splits['tex_in_root'])
-  next_referenced = referenced.copy()
-  # print(f'start_with: {start_with}')
-  while True:
-    for fn in old_referenced:
-      for fn2 in referenced:
-        if regex.search(
-            r'(?<!\w)(' + os.path.splitext(fn)[0] + r'[.}])', '\n'.join(contents[fn2])
-        ):
-          next_referenced.add(fn)
+  files_by_stem = collections.defaultdict(list)
+  for fn in splits['tex_in_root'] + splits['tex_not_in_root']:
+    files_by_stem[os.path.splitext(fn)[0]].append(fn)
+  # Longest stems first, so that 'path/to/file' is preferred over 'file' when
+  # both could match at the same position.
+  pattern = _compiled_tex_references(
+      tuple(sorted(files_by_stem, key=len, reverse=True))
+  )
+  automaton = None
+  if ahocorasick is not None and files_by_stem:
+    automaton = _build_automaton(files_by_stem)
 
-    if referenced == next_referenced:
-      splits['tex_to_copy'] = list(referenced)
-      return
+  referenced = {start_with} if start_with is not None else set(splits['tex_in_root'])
+  to_scan = list(referenced)
+  while to_scan and files_by_stem:
+    text = contents[to_scan.pop()]
+    for stem in _find_tex_references(text, pattern, automaton):
+      for fn in files_by_stem[stem]:
+        if fn not in referenced:
+          referenced.add(fn)
+          to_scan.append(fn)
 
-    referenced = next_referenced.copy()
+  splits['tex_to_copy'] = list(referenced)
 
 
 def _add_root_tex_files(splits):
@@ -740,67 +1120,75 @@ def _add_root_tex_files(splits):
 
 
 def _split_all_files(parameters):
-  """Splits the files into types or location to know what to do with them."""
+  """Splits the files into types or location to know what to do with them.
+
+  Every file is classified in a single pass, each category being matched by
+  one compiled alternation of its patterns.
+  """
+  to_delete_re = _compile_union(
+      tuple(
+          parameters['to_delete'] + parameters['figures_to_copy_if_referenced']
+      )
+  )
+  figures_re = _compile_union(
+      tuple(parameters['figures_to_copy_if_referenced'])
+  )
+  tex_re = _compile_union(('.tex$', '.tikz$'))
+  texlog_re = _compile_union(('.log$',))
+  external_tikz_re = _compile_union(
+      (parameters['use_external_tikz'],)
+      if parameters.get('use_external_tikz', None) is not None
+      else ()
+  )
+  svg_inkscape_re = _compile_union(
+      (parameters['svg_inkscape'],)
+      if parameters.get('svg_inkscape', None) is not None
+      else ()
+  )
+
   file_splits = {
       'all': _list_all_files(
           parameters['input_folder'], ignore_dirs=['.git' + os.sep]
       ),
-      'in_root': [
-          f
-          for f in os.listdir(parameters['input_folder'])
-          if os.path.isfile(os.path.join(parameters['input_folder'], f))
-      ],
   }
+  for key in [
+      'in_root',
+      'not_in_root',
+      'to_copy_in_root',
+      'to_copy_not_in_root',
+      'figures',
+      'tex_in_root',
+      'texlog_in_root',
+      'tex_not_in_root',
+      'non_tex_in_root',
+      'non_tex_not_in_root',
+      'external_tikz_figures',
+      'svg_inkscape',
+  ]:
+    file_splits[key] = []
+
+  for f in file_splits['all']:
+    location = 'in_root' if os.sep not in f else 'not_in_root'
+    file_splits[location].append(f)
+    if not to_delete_re.search(f):
+      file_splits['to_copy_' + location].append(f)
+      if tex_re.search(f):
+        file_splits['tex_' + location].append(f)
+      else:
+        file_splits['non_tex_' + location].append(f)
+      if location == 'in_root' and texlog_re.search(f):
+        file_splits['texlog_in_root'].append(f)
+    if figures_re.search(f):
+      file_splits['figures'].append(f)
+    if external_tikz_re.search(f):
+      file_splits['external_tikz_figures'].append(f)
+    if svg_inkscape_re.search(f):
+      file_splits['svg_inkscape'].append(f)
+
   if not any(file.endswith('.bbl') for file in file_splits['in_root']) and not parameters['keep_bib']:
       print("A .bbl file is not exists in the folder. Maybe use KEEP bib ?")
       parameters['keep_bib'] = True
 
-  file_splits['not_in_root'] = [
-      f for f in file_splits['all'] if f not in file_splits['in_root']
-  ]
-  file_splits['to_copy_in_root'] = _remove_pattern(
-      file_splits['in_root'],
-      parameters['to_delete'] + parameters['figures_to_copy_if_referenced'],
-  )
-  file_splits['to_copy_not_in_root'] = _remove_pattern(
-      file_splits['not_in_root'],
-      parameters['to_delete'] + parameters['figures_to_copy_if_referenced'],
-  )
-  file_splits['figures'] = _keep_pattern(
-      file_splits['all'], parameters['figures_to_copy_if_referenced']
-  )
-
-  file_splits['tex_in_root'] = _keep_pattern(
-      file_splits['to_copy_in_root'], ['.tex$', '.tikz$']
-  )
-  file_splits['texlog_in_root'] = _keep_pattern(
-      file_splits['to_copy_in_root'], ['.log$']
-  )
-  file_splits['tex_not_in_root'] = _keep_pattern(
-      file_splits['to_copy_not_in_root'], ['.tex$', '.tikz$']
-  )
-
-  file_splits['non_tex_in_root'] = _remove_pattern(
-      file_splits['to_copy_in_root'], ['.tex$', '.tikz$']
-  )
-  file_splits['non_tex_not_in_root'] = _remove_pattern(
-      file_splits['to_copy_not_in_root'], ['.tex$', '.tikz$']
-  )
-
-  if parameters.get('use_external_tikz', None) is not None:
-    file_splits['external_tikz_figures'] = _keep_pattern(
-        file_splits['all'], [parameters['use_external_tikz']]
-    )
-  else:
-    file_splits['external_tikz_figures'] = []
-
-  if parameters.get('svg_inkscape', None) is not None:
-    file_splits['svg_inkscape'] = _keep_pattern(
-        file_splits['all'], [parameters['svg_inkscape']]
-    )
-  else:
-    file_splits['svg_inkscape'] = []
-
   return file_splits
 
 
@@ -878,63 +1266,74 @@ def run_arxiv_cleaner(parameters):
         splits['tex_in_root'] + splits['tex_not_in_root'], parameters
     )
 
-    for tex_file in tex_contents:
-      logging.info('Removing comments in file %s.', tex_file)
-      tex_contents[tex_file] = _remove_comments_and_commands_to_delete(
-          tex_contents[tex_file], parameters
-      )
-
-    for tex_file in tex_contents:
-      logging.info('Replacing \\includesvg calls in file %s.', tex_file)
-      tex_contents[tex_file] = _replace_includesvg(
-          tex_contents[tex_file], splits['svg_inkscape']
-      )
-
-    for tex_file in tex_contents:
-      logging.info('Replacing Tikz Pictures in file %s.', tex_file)
-      content = _replace_tikzpictures(
-          tex_contents[tex_file], splits['external_tikz_figures']
-      )
-      # If file ends with '\n' already, the split in last line would add an extra
-      # '\n', so we remove it.
-      tex_contents[tex_file] = content.split('\n')
-
-    _keep_only_referenced_tex(tex_contents, splits, start_with=parameters['main_tex'])
-    if parameters['main_tex'] is None: # add all tex in root if the main is unknown
-        _add_root_tex_files(splits)
+    tex_files_to_clean = [
+        (
+            tex_file,
+            content,
+            parameters,
+            splits['svg_inkscape'],
+            splits['external_tikz_figures'],
+        )
+        for tex_file, content in tex_contents.items()
+    ]
+    num_jobs = min(_get_num_jobs(parameters), len(tex_files_to_clean))
+    # The pool is shared by the cleaning and the pattern replacement steps.
+    executor_context = (
+        concurrent.futures.ProcessPoolExecutor(max_workers=num_jobs)
+        if num_jobs > 1
+        else contextlib.nullcontext()
+    )
+    with executor_context as executor:
+      map_jobs = executor.map if executor is not None else map
+      tex_contents = dict(map_jobs(_clean_tex_file, tex_files_to_clean))
+
+      _keep_only_referenced_tex(tex_contents, splits, start_with=parameters['main_tex'])
+      if parameters['main_tex'] is None: # add all tex in root if the main is unknown
+          _add_root_tex_files(splits)
+
+      patterns_and_insertions = parameters.get('patterns_and_insertions')
+      if patterns_and_insertions:
+        tex_files_to_replace = [
+            (tex_file, tex_contents[tex_file], patterns_and_insertions)
+            for tex_file in splits['tex_to_copy']
+        ]
+        if len(tex_files_to_replace) < 2:
+          map_jobs = map
+        tex_contents.update(
+            map_jobs(_replace_patterns_in_tex_file, tex_files_to_replace)
+        )
 
     for tex_file in splits['tex_to_copy']:
-      logging.info('Replacing patterns in file %s.', tex_file)
-      content = '\n'.join(tex_contents[tex_file])
-      content = _find_and_replace_patterns(
-          content, parameters.get('patterns_and_insertions', list())
-      )
-      tex_contents[tex_file] = content
       new_path = os.path.join(parameters['output_folder'], tex_file)
       logging.info('Writing modified contents to %s.', new_path)
       _write_file_content(
-          content,
+          tex_contents[tex_file],
           new_path,
       )
 
-    full_content = '\n'.join(
-        ''.join(tex_contents[fn]) for fn in splits['tex_to_copy']
-    )
+    full_content = '\n'.join(tex_contents[fn] for fn in splits['tex_to_copy'])
     _copy_only_referenced_non_tex_not_in_root(parameters, full_content, splits)
+    use_tex_log = parameters['use_tex_log_for_figs'] and (parameters['use_tex_log_for_figs'] in splits['texlog_in_root']+['ALL'] )
+    # The log files are only read from the input folder, so they are not
+    # copied when they are used to find the figures.
+    logs_not_copied = set(splits['texlog_in_root']) if use_tex_log else set()
     for non_tex_file in splits['non_tex_in_root']:
+      if non_tex_file in logs_not_copied:
+        continue
       logging.info('Copying non-tex file %s.', non_tex_file)
       _copy_file(non_tex_file, parameters)
 
-    if parameters['use_tex_log_for_figs'] and (parameters['use_tex_log_for_figs'] in splits['texlog_in_root']+['ALL'] ):
+    if use_tex_log:
       logfile_name = [parameters['use_tex_log_for_figs']] # splits['texlog_in_root'][0]
       if parameters['use_tex_log_for_figs']=='ALL':
           logfile_name = splits['texlog_in_root'].copy()
-      full_content = ''
+      input_folder = parameters['input_folder']
+      log_contents = []
       for logfile_n in logfile_name:
           logging.info(f'use_tex_log_for_figs={logfile_n}')
-          full_content += '\n' + ''.join(_read_file_content(os.path.join(parameters['input_folder'], logfile_n)))
-      for fname in splits['texlog_in_root']:
-        os.remove(os.path.join(parameters['output_folder'], fname))
+          log_contents.append('\n')
+          log_contents.append(_read_file_content(os.path.join(input_folder, logfile_n)))
+      full_content = ''.join(log_contents)
     elif parameters['use_tex_log_for_figs']:
       logging.error(f'Error, missing log file {parameters["use_tex_log_for_figs"]} in {splits["texlog_in_root"]}/ALL')
 
@@ -950,17 +1349,20 @@ def strip_whitespace(text):
 
   https://stackoverflow.com/questions/8270092/remove-all-whitespace-in-a-string
   """
-  pattern = regex.compile(r'\s+')
-  text = regex.sub(pattern, '', text)
-  return text
+  if text.isascii():
+    return text.translate(_ASCII_WHITESPACE_TABLE)
+  return _WHITESPACE_RE.sub('', text)
 
 
 def merge_args_into_config(args, config_params):
-  final_args = copy.deepcopy(config_params)
-  config_keys = config_params.keys()
+  # Only the containers that may be updated below need to be copied.
+  final_args = {
+      key: value.copy() if isinstance(value, (dict, list)) else value
+      for key, value in config_params.items()
+  }
   for key, value in args.items():
-    if key in config_keys:
-      if any([isinstance(value, t) for t in [str, bool, float, int]]):
+    if key in config_params:
+      if isinstance(value, (str, bool, float, int)):
         # Overwrites config value with args value.
         final_args[key] = value
       elif isinstance(value, list):
@@ -974,6 +1376,180 @@ def merge_args_into_config(args, config_params):
   return final_args
 
 
+@functools.lru_cache(maxsize=None)
+def _compiled_patterns_union(patterns):
+  """Compiles one alternation of the user 'patterns', or None if impossible.
+
+  The alternative of the i-th pattern is the group named '_alt<i>'. Patterns
+  may share group names, which the regex module allows (re does not, so such
+  alternations are compiled with regex).
+  """
+  if any(_UNCOMBINABLE_PATTERN_RE.search(pattern) for pattern in patterns):
+    return None
+  try:
+    return _compile(
+        '|'.join(
+            '(?P<_alt{}>{})'.format(i, pattern)
+            for i, pattern in enumerate(patterns)
+        )
+    )
+  except regex.error:
+    return None
+
+
+def _find_groups(pattern):
+  """Returns {open: (close, has_alternation)} for the groups of 'pattern'.
+
+  Returns None if the pattern has an alternation outside of any group or
+  unbalanced parentheses.
+  """
+  groups = {}
+  stack = []
+  i = 0
+  while i < len(pattern):
+    c = pattern[i]
+    if c == '\\':
+      i += 2
+      continue
+    if c == '[':
+      # Skips the character set, where a leading ']' is a literal.
+      i += 1
+      if pattern[i : i + 1] == '^':
+        i += 1
+      if pattern[i : i + 1] == ']':
+        i += 1
+      while i < len(pattern) and pattern[i] != ']':
+        i += 2 if pattern[i] == '\\' else 1
+    elif c == '(':
+      stack.append(i)
+      groups[i] = [None, False]
+    elif c == ')':
+      if not stack:
+        return None
+      groups[stack.pop()][0] = i
+    elif c == '|':
+      if not stack:
+        return None
+      groups[stack[-1]][1] = True
+    i += 1
+  if stack:
+    return None
+  return {start: tuple(group) for start, group in groups.items()}
+
+
+@functools.lru_cache(maxsize=None)
+def _extract_literal_prefix(pattern):
+  """Returns a text that every match of the user 'pattern' starts with.
+
+  The parsing is conservative: it stops at the first construct that is not a
+  plain (or escaped) character, entering only capturing and non-capturing
+  groups without alternation. An empty string means no prefix is known.
+  """
+  if _GLOBAL_FLAGS_RE.search(pattern) or _FUZZY_CONSTRAINT_RE.search(
+      pattern
+  ):
+    return ''
+  groups = _find_groups(pattern)
+  if groups is None:
+    return ''
+  prefix = []
+  open_groups = []  # (position of '(', length of the prefix before it)
+  i = 0
+  while i < len(pattern):
+    c = pattern[i]
+    if c == '(':
+      if pattern.startswith('(?:', i):
+        content_start = i + 3
+      elif pattern.startswith('(?P<', i):
+        content_start = pattern.find('>', i) + 1
+      elif not pattern.startswith('(?', i):
+        content_start = i + 1
+      else:
+        break
+      if groups[i][1]:
+        break
+      open_groups.append((i, len(prefix)))
+      i = content_start
+      continue
+    if c in '*?' or _BRACE_QUANTIFIER_RE.match(pattern, i):
+      # The previous character may be optional.
+      if prefix:
+        prefix.pop()
+      break
+    if c in '.^$|[)+':
+      break
+    if c == '\\':
+      escaped = pattern[i + 1 : i + 2]
+      if not escaped or escaped.isalnum() or not escaped.isascii():
+        break
+      prefix.append(escaped)
+      i += 2
+    else:
+      prefix.append(c)
+      i += 1
+  # Groups the prefix is part of must not be optional.
+  for start, prefix_length in open_groups:
+    close = groups[start][0]
+    if pattern[close + 1 : close + 2] in (
+        '*',
+        '?',
+    ) or _BRACE_QUANTIFIER_RE.match(pattern, close + 1):
+      del prefix[prefix_length:]
+      break
+  return ''.join(prefix)
+
+
+def _may_match(pattern_and_insertion, content):
+  """Returns False if the user pattern surely does not match in content."""
+  literal_prefix = pattern_and_insertion.get(
+      'literal_prefix'
+  ) or _extract_literal_prefix(pattern_and_insertion['pattern'])
+  return not literal_prefix or literal_prefix in content
+
+
+@functools.lru_cache(maxsize=None)
+def _compiled_user_pattern(pattern):
+  """Compiles a user pattern once per process, for every file using it."""
+  return _compile(pattern)
+
+
+def _insertion_function(pattern_and_insertion, log_matches):
+  """Returns the function giving the insertion replacing a user pattern match.
+
+  The options of the pattern are read once rather than for every match, and an
+  insertion without replacement fields is only formatted once.
+  """
+  insertion = pattern_and_insertion['insertion']
+  strip = pattern_and_insertion.get('strip_whitespace', True)
+  if not log_matches:
+    try:
+      has_fields = any(
+          field is not None
+          for _, field, _, _ in string.Formatter().parse(insertion)
+      )
+    except ValueError:
+      # The error is raised when formatting the insertion of a match.
+      has_fields = True
+    if not has_fields:
+      constant_insertion = insertion.format_map({})
+      if strip:
+        constant_insertion = strip_whitespace(constant_insertion)
+      return lambda m: constant_insertion
+
+  format_insertion = insertion.format_map
+
+  def make_insertion(m):
+    local_insertion = format_insertion(m.groupdict())
+    if strip:
+      local_insertion = strip_whitespace(local_insertion)
+    if log_matches:
+      logging.info(f'Found {m.group(0):<70}')
+      logging.info(f'Replacing with {local_insertion:<30}')
+    return local_insertion
+
+  return make_insertion
+
+
 def _find_and_replace_patterns(content, patterns_and_insertions):
   r"""content: str
 
@@ -990,21 +1566,65 @@ def _find_and_replace_patterns(content, patterns_and_insertions):
               "description": "Replace figcompfigures"
           },
       ]
+
+  A pattern is only searched if its literal prefix, either given under the
+  optional "literal_prefix" key or extracted from the pattern, is found in the
+  content. Matches are replaced in a single pass, so an insertion is not
+  searched again. When the patterns can all be combined in one alternation,
+  which does not depend on the content, the content is scanned once: the first
+  pattern matching at a position wins, and the insertions of a pattern are not
+  searched by the next ones.
   """
+  # Formatting the messages of every match is skipped when they are not shown.
+  log_matches = logging.getLogger().isEnabledFor(logging.INFO)
+  if (
+      len(patterns_and_insertions) > 1
+      and _compiled_patterns_union(
+          tuple(pi['pattern'] for pi in patterns_and_insertions)
+      )
+      is not None
+  ):
+    candidates = [
+        pi for pi in patterns_and_insertions if _may_match(pi, content)
+    ]
+    if not candidates:
+      return content
+    union = _compiled_patterns_union(tuple(pi['pattern'] for pi in candidates))
+    logging.info(
+        'Processing patterns: %s.',
+        ', '.join(pi['description'] for pi in candidates),
+    )
+    # Maps the group of each alternative to its pattern. With re, the group
+    # closed last by a match is always the one of its alternative.
+    handlers = {
+        union.groupindex['_alt{}'.format(i)]: _insertion_function(
+            pattern_and_insertion, log_matches
+        )
+        for i, pattern_and_insertion in enumerate(candidates)
+    }
+
+    def replace_any(m):
+      make_insertion = handlers.get(m.lastindex)
+      if make_insertion is None:
+        # The regex module may report a group nested in the alternative.
+        for group, make_insertion in handlers.items():
+          if m.start(group) != -1:
+            break
+      return make_insertion(m)
+
+    content = union.sub(replace_any, content)
+    logging.info('Finished patterns.')
+    return content
+
   for pattern_and_insertion in patterns_and_insertions:
-    pattern = pattern_and_insertion['pattern']
-    insertion = pattern_and_insertion['insertion']
     description = pattern_and_insertion['description']
+    if not _may_match(pattern_and_insertion, content):
+      logging.info('Skipping pattern not found: %s.', description)
+      continue
     logging.info('Processing pattern: %s.', description)
-    p = regex.compile(pattern)
-    m = p.search(content)
-    while m is not None:
-      local_insertion = insertion.format(**m.groupdict())
-      if pattern_and_insertion.get('strip_whitespace', True):
-        local_insertion = strip_whitespace(local_insertion)
-      logging.info(f'Found {content[m.start():m.end()]:<70}')
-      logging.info(f'Replacing with {local_insertion:<30}')
-      content = content[: m.start()] + local_insertion + content[m.end() :]
-      m = p.search(content)
+    pattern = _compiled_user_pattern(pattern_and_insertion['pattern'])
+    content = pattern.sub(
+        _insertion_function(pattern_and_insertion, log_matches), content
+    )
     logging.info('Finished pattern: %s.', description)
   return content
@@ -15,6 +15,7 @@
 
 from os import path
 import shutil
+import tempfile
 import unittest
 from absl.testing import parameterized
 from arxiv_latex_cleaner import arxiv_latex_cleaner
@@ -83,6 +84,26 @@ def make_patterns():
   return [output]
 
 
+def make_find_tex_references_tests():
+  return (
+      {
+          'testcase_name': 'path_and_name',
+          'text': '\\input{sections/intro}',
+          'true_outputs': {'sections/intro', 'intro'},
+      },
+      {
+          'testcase_name': 'word_boundary',
+          'text': '\\input{myintro} \\input{intro.tex}',
+          'true_outputs': {'intro'},
+      },
+      {
+          'testcase_name': 'not_followed_by_brace_or_dot',
+          'text': '\\input{intro_2}',
+          'true_outputs': set(),
+      },
+  )
+
+
 def make_search_reference_tests():
   return (
       {
@@ -319,6 +340,31 @@ class UnitTests(parameterized.TestCase):
         arxiv_latex_cleaner._remove_comments_inline(line_in), true_output
     )
 
+  @parameterized.named_parameters(
+      {
+          'testcase_name': 'multiple_lines',
+          'text_in': 'Foo %Comment\n% Comment\nBar\n',
+          'true_output': 'Foo %\nBar\n',
+      },
+      {
+          'testcase_name': 'auto_ignore_only_on_its_line',
+          'text_in': 'Foo % auto-ignore Comment\nBar % Comment\n',
+          'true_output': 'Foo % auto-ignore\nBar %\n',
+      },
+      {
+          'testcase_name': 'url_then_comment',
+          'text_in': '\\url{a%20b} Foo %Comment\n\\url{c%20d}\n',
+          'true_output': '\\url{a%20b} Foo %\n\\url{c%20d}\n',
+      },
+      {
+          'testcase_name': 'no_final_newline',
+          'text_in': 'Foo\nBar %Comment',
+          'true_output': 'Foo\nBar %\n',
+      },
+  )
+  def test_strip_comments(self, text_in, true_output):
+    self.assertEqual(arxiv_latex_cleaner._strip_comments(text_in), true_output)
+
   @parameterized.named_parameters(
       {
           'testcase_name': 'no_command',
@@ -356,6 +402,12 @@ class UnitTests(parameterized.TestCase):
           'keep_text': False,
           'true_output': 'A\n%\nE\n\\end{document}',
       },
+      {
+          'testcase_name': 'command_with_escaped_braces_removed',
+          'text_in': 'A\\todo{B\\}C\\{D}E\n\\end{document}',
+          'keep_text': False,
+          'true_output': 'AE\n\\end{document}',
+      },
       {
           'testcase_name': 'no_command_keep_text',
           'text_in': 'Foo\nFoo2\n',
@@ -517,6 +569,34 @@ class UnitTests(parameterized.TestCase):
         arxiv_latex_cleaner._simplify_conditional_blocks(text_in), true_output
     )
 
+  @parameterized.named_parameters(
+      {
+          'testcase_name': 'no_end',
+          'text_in': 'Foo\nBar\n',
+          'true_output': 'Foo\nBar\n',
+      },
+      {
+          'testcase_name': 'end_removes_rest',
+          'text_in': 'Foo\n\\end{document} Bar\nBaz\n',
+          'true_output': 'Foo\n\\end{document} Bar\n',
+      },
+      {
+          'testcase_name': 'commented_end_ignored',
+          'text_in': '% \\end{document}\nFoo\n\\end{document}% Bar\nBaz',
+          'true_output': '% \\end{document}\nFoo\n\\end{document}% Bar\n',
+      },
+      {
+          'testcase_name': 'end_on_last_line',
+          'text_in': 'Foo\n\\end{document}',
+          'true_output': 'Foo\n\\end{document}',
+      },
+  )
+  def test_strip_tex_contents(self, text_in, true_output):
+    self.assertEqual(
+        arxiv_latex_cleaner._strip_tex_contents(text_in, '\\end{document}'),
+        true_output,
+    )
+
   @parameterized.named_parameters(
       {
           'testcase_name': 'all_pass',
@@ -530,6 +610,18 @@ class UnitTests(parameterized.TestCase):
           'patterns': ['a$'],
           'true_outputs': ['bca'],
       },
+      {
+          'testcase_name': 'several_patterns',
+          'inputs': ['abc', 'bca', 'cab'],
+          'patterns': ['a$', '^c'],
+          'true_outputs': ['bca', 'cab'],
+      },
+      {
+          'testcase_name': 'no_patterns',
+          'inputs': ['abc', 'bca'],
+          'patterns': [],
+          'true_outputs': [],
+      },
   )
   def test_keep_pattern(self, inputs, patterns, true_outputs):
     self.assertEqual(
@@ -549,6 +641,18 @@ class UnitTests(parameterized.TestCase):
           'patterns': ['a$'],
           'true_outputs': ['abc'],
       },
+      {
+          'testcase_name': 'several_patterns',
+          'inputs': ['abc', 'bca', 'cab'],
+          'patterns': ['a$', '^c'],
+          'true_outputs': ['abc'],
+      },
+      {
+          'testcase_name': 'no_patterns',
+          'inputs': ['abc', 'bca'],
+          'patterns': [],
+          'true_outputs': ['abc', 'bca'],
+      },
   )
   def test_remove_pattern(self, inputs, patterns, true_outputs):
     self.assertEqual(
@@ -556,6 +660,94 @@ class UnitTests(parameterized.TestCase):
         true_outputs,
     )
 
+  @parameterized.named_parameters(
+      {
+          'testcase_name': 'fuzzy_matching',
+          'pattern': r'(?:color){e<=1}',
+          'text': 'colour',
+          'true_output': 'colou',
+      },
+      {
+          'testcase_name': 'word_with_combining_mark',
+          'pattern': r'\w+',
+          'text': 'e\u0301t\u00e9',
+          'true_output': 'e\u0301t\u00e9',
+      },
+      {
+          'testcase_name': 'escaped_brace',
+          'pattern': r'\\begin\{document}',
+          'text': r'\begin{document}',
+          'true_output': r'\begin{document}',
+      },
+  )
+  def test_compile(self, pattern, text, true_output):
+    self.assertEqual(
+        arxiv_latex_cleaner._compile(pattern).search(text).group(0),
+        true_output,
+    )
+
+  @parameterized.named_parameters(
+      {
+          'testcase_name': 'escaped_command',
+          'pattern': r'\\red{(?P<text>.*?)}',
+          'true_output': '\\red{',
+      },
+      {
+          'testcase_name': 'inside_group',
+          'pattern': r'(?:\\figcompfigures{\s*)(?P<first>.*?)\s*}',
+          'true_output': '\\figcompfigures{',
+      },
+      {
+          'testcase_name': 'optional_character',
+          'pattern': r'ab?c',
+          'true_output': 'a',
+      },
+      {
+          'testcase_name': 'optional_group',
+          'pattern': r'(ab)?c',
+          'true_output': '',
+      },
+      {
+          'testcase_name': 'alternation',
+          'pattern': r'ab|cd',
+          'true_output': '',
+      },
+      {
+          'testcase_name': 'global_flag',
+          'pattern': r'(?i)abc',
+          'true_output': '',
+      },
+      {
+          'testcase_name': 'fuzzy_matching',
+          'pattern': r'(?:colour){e<=1}',
+          'true_output': '',
+      },
+      {
+          'testcase_name': 'fuzzy_matching_character',
+          'pattern': r'abc{e<=1}',
+          'true_output': '',
+      },
+  )
+  def test_extract_literal_prefix(self, pattern, true_output):
+    self.assertEqual(
+        arxiv_latex_cleaner._extract_literal_prefix(pattern), true_output
+    )
+
+  @parameterized.named_parameters(
+      {
+          'testcase_name': 'ascii',
+          'text_in': ' a\tb\n c\r\x0b\x0cd ',
+          'true_output': 'abcd',
+      },
+      {
+          'testcase_name': 'unicode',
+          'text_in': 'a\u00a0b\u2003 c\u00e9',
+          'true_output': 'abc\u00e9',
+      },
+  )
+  def test_strip_whitespace(self, text_in, true_output):
+    self.assertEqual(arxiv_latex_cleaner.strip_whitespace(text_in), true_output)
+
   @parameterized.named_parameters(
       {
           'testcase_name': 'replace_contents',
@@ -567,16 +759,93 @@ class UnitTests(parameterized.TestCase):
               r'& \parbox[c]{\ww\linewidth}{\includegraphics[width=1.0\linewidth]{figures/image2.jpg}}'
           ),
       },
+
+      {
+          'testcase_name': 'several_patterns',
+          'content': '\\red{a} \\blue{b} \\red{c}',
+          'patterns_and_insertions': [
+              {
+                  'pattern': r'\\red{(?P<text>.*?)}',
+                  'insertion': r'\textcolor{{red}}{{{text}}}',
+                  'description': 'Replace red',
+              },
+              {
+                  'pattern': r'\\blue{(?P<text>.*?)}',
+                  'insertion': r'\textcolor{{blue}}{{{text}}}',
+                  'description': 'Replace blue',
+              },
+          ],
+          'true_outputs': (
+              r'\textcolor{red}{a} \textcolor{blue}{b} \textcolor{red}{c}'
+          ),
+      },
+      {
+          'testcase_name': 'several_patterns_nested_groups',
+          'content': '\\red{a} \\blue{b}{c}',
+          'patterns_and_insertions': [
+              {
+                  'pattern': r'\\red{(?P<red>.*?)}',
+                  'insertion': r'\textcolor{{red}}{{{red}}}',
+                  'description': 'Replace red',
+              },
+              {
+                  'pattern': r'\\blue{(?P<first>.*?)}({(?P<second>.*?)})?',
+                  'insertion': r'\textcolor{{blue}}{{{first}{second}}}',
+                  'description': 'Replace blue',
+              },
+          ],
+          'true_outputs': r'\textcolor{red}{a} \textcolor{blue}{bc}',
+      },
+      {
+          'testcase_name': 'uncombinable_patterns',
+          'content': 'aa bb',
+          'patterns_and_insertions': [
+              {
+                  'pattern': r'(\w)\1',
+                  'insertion': 'x',
+                  'description': 'Replace doubled letters',
+              },
+              {
+                  'pattern': r'x',
+                  'insertion': 'y',
+                  'description': 'Replace x',
+              },
+          ],
+          'true_outputs': 'y y',
+      },
+      {
+          'testcase_name': 'combined_patterns_single_candidate',
+          'content': r'\old{a}',
+          'patterns_and_insertions': [
+              {
+                  'pattern': r'\\old{(?P<x>[^}]*)}',
+                  'insertion': r'\new{{{x}}}',
+                  'description': 'Replace old',
+              },
+              {
+                  'pattern': r'\\new{(?P<x>[^}]*)}',
+                  'insertion': r'\final{{{x}}}',
+                  'description': 'Replace new',
+              },
+          ],
+          'true_outputs': r'\new{a}',
+      },
   )
   def test_find_and_replace_patterns(
       self, content, patterns_and_insertions, true_outputs
   ):
+    original_patterns_and_insertions = [
+        dict(pattern_and_insertion)
+        for pattern_and_insertion in patterns_and_insertions
+    ]
     output = arxiv_latex_cleaner._find_and_replace_patterns(
         content, patterns_and_insertions
     )
     output = arxiv_latex_cleaner.strip_whitespace(output)
     true_outputs = arxiv_latex_cleaner.strip_whitespace(true_outputs)
     self.assertEqual(output, true_outputs)
+    # The patterns of the config are not modified.
+    self.assertEqual(patterns_and_insertions, original_patterns_and_insertions)
 
   @parameterized.named_parameters(
       {
@@ -677,6 +946,116 @@ class UnitTests(parameterized.TestCase):
         true_output,
     )
 
+  @parameterized.named_parameters(
+      {
+          'testcase_name': 'exact_name',
+          'filename': 'sections/intro',
+          'true_output': 'sections/intro.tex',
+      },
+      {
+          'testcase_name': 'with_extension',
+          'filename': 'intro.tex',
+          'true_output': 'intro.tex',
+      },
+      {
+          'testcase_name': 'substring',
+          'filename': 'conclusion',
+          'true_output': 'sections/conclusion.tex',
+      },
+      {
+          'testcase_name': 'missing',
+          'filename': 'appendix',
+          'true_output': None,
+      },
+  )
+  def test_find_input_file(self, filename, true_output):
+    tex_files = ['intro.tex', 'sections/intro.tex', 'sections/conclusion.tex']
+    index = {path.splitext(fn)[0]: fn for fn in tex_files}
+    index.update({fn: fn for fn in tex_files})
+    self.assertEqual(
+        arxiv_latex_cleaner._find_input_file(filename, tex_files, index),
+        true_output,
+    )
+
+  def test_flat_latex_shared_stem(self):
+    contents = {
+        'main.tex': 'Foo\n\\input{figs/plot}\nBar\n',
+        'figs/plot.tex': 'TEX\n',
+        'figs/plot.tikz': 'TIKZ\n',
+    }
+    with tempfile.TemporaryDirectory() as output_folder:
+      # The .tex file is inlined, whichever order the files are listed in.
+      for tex_files in (list(contents), list(reversed(contents))):
+        arxiv_latex_cleaner._create_dir_if_not_exists(
+            path.join(output_folder, 'figs')
+        )
+        for fn, content in contents.items():
+          arxiv_latex_cleaner._write_file_content(
+              content, path.join(output_folder, fn)
+          )
+        arxiv_latex_cleaner._flat_latex(
+            {'output_folder': output_folder, 'main_tex': 'main.tex'},
+            '',
+            {'tex_to_copy': tex_files},
+        )
+        with open(path.join(output_folder, 'main.tex')) as f:
+          self.assertEqual(f.read(), 'Foo\nTEX\nBar\n')
+
+  @parameterized.named_parameters(
+      {
+          'testcase_name': 'nested_references',
+          'contents': {
+              'main.tex': '\\input{sections/intro}',
+              'sections/intro.tex': '\\input{figures/fig.tex}',
+              'figures/fig.tex': 'Foo',
+              'unused.tex': '\\input{main}',
+          },
+          'start_with': 'main.tex',
+          'true_outputs': ['figures/fig.tex', 'main.tex', 'sections/intro.tex'],
+      },
+      {
+          'testcase_name': 'all_root_files',
+          'contents': {
+              'main.tex': '\\input{figures/fig}',
+              'other.tex': 'Foo',
+              'figures/fig.tex': 'Foo',
+              'figures/unused.tex': 'Foo',
+          },
+          'start_with': None,
+          'true_outputs': ['figures/fig.tex', 'main.tex', 'other.tex'],
+      },
+  )
+  def test_keep_only_referenced_tex(self, contents, start_with, true_outputs):
+    splits = {
+        'tex_in_root': [fn for fn in contents if '/' not in fn],
+        'tex_not_in_root': [fn for fn in contents if '/' in fn],
+    }
+    arxiv_latex_cleaner._keep_only_referenced_tex(contents, splits, start_with)
+    self.assertEqual(sorted(splits['tex_to_copy']), true_outputs)
+
+  @parameterized.named_parameters(*make_find_tex_references_tests())
+  def test_find_tex_references(self, text, true_outputs):
+    pattern = arxiv_latex_cleaner._compiled_tex_references(
+        ('sections/intro', 'intro')
+    )
+    self.assertEqual(
+        arxiv_latex_cleaner._find_tex_references(text, pattern),
+        true_outputs,
+    )
+
+  @parameterized.named_parameters(*make_find_tex_references_tests())
+  @unittest.skipIf(
+      arxiv_latex_cleaner.ahocorasick is None, 'ahocorasick is not installed'
+  )
+  def test_find_tex_references_automaton(self, text, true_outputs):
+    stems = ('sections/intro', 'intro')
+    pattern = arxiv_latex_cleaner._compiled_tex_references(stems)
+    automaton = arxiv_latex_cleaner._build_automaton(stems)
+    self.assertEqual(
+        arxiv_latex_cleaner._find_tex_references(text, pattern, automaton),
+        true_outputs,
+    )
+
   @parameterized.named_parameters(*make_search_reference_tests())
   def test_search_reference_weak(
       self, filenames, contents, strict, true_outputs
@@ -713,6 +1092,21 @@ class UnitTests(parameterized.TestCase):
       msg = 'fatal, see test_search_reference_weak'
     self.assertEqual(cleaner_outputs, true_outputs, msg)
 
+  @parameterized.named_parameters(*make_search_reference_tests())
+  def test_keep_only_referenced(
+      self, filenames, contents, strict, true_outputs
+  ):
+    # Prefiltering the filenames matches searching them one by one.
+    self.assertEqual(
+        arxiv_latex_cleaner._keep_only_referenced(filenames, contents, strict),
+        [
+            fn
+            for fn in filenames
+            if arxiv_latex_cleaner._search_reference(fn, contents, strict)
+            is not None
+        ],
+    )
+
   @parameterized.named_parameters(
       {
           'testcase_name': 'three_parent',
@@ -950,5 +1344,50 @@ class IntegrationTests(parameterized.TestCase):
     super(IntegrationTests, self).tearDown()
 
 
+
+class ParallelTests(parameterized.TestCase):
+
+  def _run_cleaner(self, jobs):
+    """Cleans a copy of the 'tex' folder and returns the output contents."""
+    with tempfile.TemporaryDirectory() as tempdir:
+      input_folder = path.join(tempdir, 'tex')
+      shutil.copytree('tex', input_folder)
+      parameters = {
+          'input_folder': input_folder,
+          'main_tex': 'main.tex',
+          'images_allowlist': {},
+          'resize_images': False,
+          'im_size': 100,
+          'compress_pdf': False,
+          'pdf_im_resolution': 500,
+          'png_to_jpg_compress': False,
+          'commands_to_delete': ['mytodo'],
+          'commands_only_to_delete': ['red'],
+          'if_exceptions': ['iffalt'],
+          'environments_to_delete': ['mynote'],
+          'use_external_tikz': 'ext_tikz',
+          'use_tex_log_for_figs': None,
+          'svg_inkscape': None,
+          'flattening': False,
+          'keep_bib': False,
+          'jobs': jobs,
+          'patterns_and_insertions': [{
+              'pattern': r'\\red{(?P<text>[^}]*)}',
+              'insertion': '{text}',
+              'description': 'Replace red',
+          }],
+      }
+      arxiv_latex_cleaner.run_arxiv_cleaner(parameters)
+      output_folder = parameters['output_folder']
+      contents = {}
+      for filename in arxiv_latex_cleaner._list_all_files(output_folder):
+        with open(path.join(output_folder, filename), 'rb') as f:
+          contents[filename] = f.read()
+      return contents
+
+  def test_jobs_match_serial(self):
+    self.assertEqual(self._run_cleaner(jobs=2), self._run_cleaner(jobs=1))
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -43,9 +43,10 @@ setup(
     long_description=long_description,
     long_description_content_type="text/markdown",
     entry_points={
-        "console_scripts": ["arxiv_latex_cleaner=arxiv_latex_cleaner.__main__:__main__"]
+        "console_scripts": ["arxiv_latex_cleaner=arxiv_latex_cleaner.__main__:main"]
     },
     install_requires=install_requires,
+    extras_require={"fast": ["pyahocorasick"]},
     classifiers=[
         "License :: OSI Approved :: Apache Software License",
         "Intended Audience :: Science/Research",